@@ -5,6 +5,8 @@ conda subchannel subcommand for CLI
 from __future__ import annotations
 
 import argparse
+import math
+import re
 from logging import getLogger
 from datetime import datetime, timezone
 
@@ -12,27 +14,56 @@ from conda.exceptions import ArgumentError
 from conda.base.constants import REPODATA_FN
 from conda.base.context import context
 from conda.common.io import Spinner
+from conda.core.subdir_data import SubdirData
 from conda.models.channel import Channel
 
-from .core import _fetch_channel, _reduce_index, _dump_records, _write_to_disk
+from .core import (
+    ZSTD_COMPRESS_LEVEL,
+    ZSTD_MAX_COMPRESS_LEVEL,
+    _fetch_channel,
+    _parse_zstd_level,
+    _reduce_index,
+    _dump_records,
+    _write_to_disk,
+    _zstd_level_from_env,
+    _zstd_threads_from_env,
+)
 
 log = getLogger(f"conda.{__name__}")
 
+ISO_DATETIME_RE = re.compile(r"\d{4}-\d{2}-\d{2}(?:T\d{2}:\d{2}(?::\d{2})?)?")
+DATE_FORMATS = "ts:<float>, YYYY-MM-DD[THH:MM[:SS]] or YYYY-[MM[-DD[-HH[-MM[-SS]]]]] (UTC)"
+
 
 def date_argument(date: str) -> float:
-    date = str(date).split("-")
-    if len(date) == 1 and date[0].startswith("ts:"):
-        return datetime.fromtimestamp(float(date[0][3:]), timezone.utc).timestamp()
+    date = str(date)
+    if date.startswith("ts:"):
+        timestamp = float(date[3:])
+        # nan would silently make every --after/--before comparison false
+        if not math.isfinite(timestamp) or timestamp < 0:
+            raise ValueError(f"Wrong timestamp {date}. Needs a finite, non-negative number.")
+        try:
+            return datetime.fromtimestamp(timestamp, timezone.utc).timestamp()
+        except (OverflowError, OSError) as exc:  # beyond what datetime can represent
+            raise ValueError(f"Wrong timestamp {date}. {exc}") from exc
+    if ISO_DATETIME_RE.fullmatch(date):
+        # Only the forms that datetime.fromisoformat() parses on every supported Python
+        return datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp()
+    date = date.split("-")
     if len(date) == 1:
         date.extend(["1", "1"])
     elif len(date) == 2:
         date.append("1")
     if 3 <= len(date) <= 6:  # YYYY-[MM[-DD[-HH[-MM[-SS]]]]]
         return datetime(*[int(x) for x in date], tzinfo=timezone.utc).timestamp()
-    raise ValueError(
-        f"Wrong date {date}. "
-        "Needs timestamp as ts:<float> or date as YYYY-[MM[-DD[-HH[-MM[-SS]]]]]"
-    )
+    raise ValueError(f"Wrong date {date}. Needs {DATE_FORMATS}")
+
+
+def zstd_level_argument(level: str) -> int:
+    try:
+        return _parse_zstd_level(level)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
 
 
 def configure_parser(parser: argparse.ArgumentParser):
@@ -67,6 +98,20 @@ def configure_parser(parser: argparse.ArgumentParser):
         help="URL or location where the subchannel files will be eventually served. "
         "Used for the HTML output.",
     )
+    parser.add_argument(
+        "--emit-bz2",
+        action="store_true",
+        help="Also write repodata.json.bz2 for legacy clients. Only repodata.json and "
+        "repodata.json.zst are written by default.",
+    )
+    parser.add_argument(
+        "--zstd-level",
+        type=zstd_level_argument,
+        metavar="LEVEL",
+        help="Compression level for repodata.json.zst, from 1 to "
+        f"{ZSTD_MAX_COMPRESS_LEVEL}. Defaults to $CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL or "
+        f"{ZSTD_COMPRESS_LEVEL}. Higher levels produce smaller files but are much slower.",
+    )
     parser.add_argument(
         "--subdir",
         "--platform",
@@ -79,13 +124,13 @@ def configure_parser(parser: argparse.ArgumentParser):
     parser.add_argument(
         "--after",
         metavar="TIME",
-        help="Timestamp as ts:<float> or date as YYYY-[MM[-DD[-HH[-MM[-SS]]]]]",
+        help=f"Timestamp or date as {DATE_FORMATS}.",
         type=date_argument,
     )
     parser.add_argument(
         "--before",
         metavar="TIME",
-        help="Timestamp as ts:<float> or date as YYYY-[MM[-DD[-HH[-MM[-SS]]]]]",
+        help=f"Timestamp or date as {DATE_FORMATS}.",
         type=date_argument,
     )
     parser.add_argument(
@@ -117,14 +162,17 @@ def configure_parser(parser: argparse.ArgumentParser):
 def execute(args: argparse.Namespace) -> int:
     if not any([args.after, args.before, args.keep, args.remove, args.keep_tree, args.prune]):
         raise ArgumentError("Please provide at least one filter.")
+    # Validate the output settings before the (slow) fetching and filtering
+    zstd_level = args.zstd_level if args.zstd_level is not None else _zstd_level_from_env()
+    zstd_threads = _zstd_threads_from_env()
 
     with Spinner("Syncing source channel"):
         subdirs = args.subdirs or context.subdirs
         if "noarch" not in subdirs:
             subdirs = *subdirs, "noarch"
         subdir_datas = _fetch_channel(args.channel, subdirs, args.repodata_fn)
-    for sd in sorted(subdir_datas, key=lambda sd: sd.channel.name):
-        print(" -", sd.channel.name, sd.channel.subdir)
+    for name, subdir in sorted((sd.channel.name, sd.channel.subdir) for sd in subdir_datas):
+        print(" -", name, subdir)
 
     kwargs = {
         "subdir_datas": subdir_datas,
@@ -144,16 +192,25 @@ def execute(args: argparse.Namespace) -> int:
         return 1
     print(" - Reduced from", total_count, "to", filtered_count, "records")
 
+    # The full source channel is no longer needed; drop it (and conda's in-memory cache of it)
+    # before building the output
+    kwargs.pop("subdir_datas")
+    del subdir_datas
+    SubdirData.clear_cached_local_channel_data(exclude_file=False)
+
     with Spinner(f"Writing output to {args.output}"):
         base_url = args.base_url or Channel(args.channel).base_url
         repodatas = _dump_records(records, base_url)
-        kwargs.pop("subdir_datas")
+        del records
         _write_to_disk(
             args.channel,
             repodatas,
             args.output,
             cli_flags=kwargs,
             served_at=args.served_at,
+            outputs=("bz2", "zstd") if args.emit_bz2 else ("zstd",),
+            zstd_level=zstd_level,
+            zstd_threads=zstd_threads,
         )
 
     return 0
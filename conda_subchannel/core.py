@@ -5,71 +5,226 @@ import bz2
 import hashlib
 import json
 import logging
+import mmap
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import jinja2
 import zstandard
-from conda.base.context import context
+from conda.auxlib import NULL
 from conda.common.io import ThreadLimitedThreadPoolExecutor
 from conda.base.constants import REPODATA_FN
 from conda.core.subdir_data import SubdirData
+from conda.exceptions import CondaValueError
 from conda.models.channel import Channel
 from conda.models.match_spec import MatchSpec
 from conda.models.version import VersionOrder
 
+try:
+    import orjson
+except ImportError:  # optional, faster JSON serialization
+    orjson = None
+
 if TYPE_CHECKING:
     import os
-    from typing import Any, Iterable, Iterator
+    from typing import Any, Callable, Iterable, Iterator
 
     from conda.models.match_spec import MatchSpec
     from conda.models.records import PackageRecord
 
-ZSTD_COMPRESS_LEVEL = 16
-ZSTD_COMPRESS_THREADS = -1  # automatic
+# Level 3 is ~40x faster than level 16 for a few percent larger files; repodata is regenerated
+# often, so favor speed. Archival use cases can go up to 22.
+ZSTD_COMPRESS_LEVEL = 3
+ZSTD_MAX_COMPRESS_LEVEL = zstandard.MAX_COMPRESSION_LEVEL
+# Multi-threaded zstd scales almost linearly on multi-MB inputs; leave a couple of cores for
+# the JSON encoding and the bz2 writer running alongside it
+ZSTD_COMPRESS_THREADS = max(1, (os.cpu_count() or 1) - 2)
+BZ2_COMPRESS_LEVEL = 6  # 9 needs more memory for a marginal ratio gain
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+# Per subdir record of what the repodata files were last written from; not listed in index.html
+REPODATA_STATE_FN = ".repodata.state.json"
+TEMPLATES_DIR = Path(__file__).parent / "templates"
+
+# Fields of each record that are written to the output repodata.json. Keep sorted: records
+# are dumped in this order and the JSON encoder does not sort keys.
+REPODATA_RECORD_KEYS = (
+    "build",
+    "build_number",
+    "constrains",
+    "depends",
+    "license",
+    "md5",
+    "name",
+    "sha256",
+    "size",
+    "subdir",
+    "timestamp",
+    "version",
+)
 
 log = logging.getLogger(f"conda.{__name__}")
 
 
+def _parse_int(value: str, minimum: int, maximum: int | None = None) -> int:
+    """
+    Parse ``value`` as an integer in ``[minimum, maximum]``, or raise ValueError saying so.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum or (maximum is not None and number > maximum):
+        expected = f"between {minimum} and {maximum}" if maximum is not None else f">= {minimum}"
+        raise ValueError(f"must be an integer {expected}, got '{value}'.")
+    return number
+
+
+def _parse_zstd_level(value: str) -> int:
+    # Shared by --zstd-level and CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL
+    return _parse_int(value, 1, ZSTD_MAX_COMPRESS_LEVEL)
+
+
+def _parse_zstd_threads(value: str) -> int:
+    # 0 disables multi-threading; -1 uses all cores
+    return _parse_int(value, -1)
+
+
+def _setting_from_env(name: str, parse: Callable[[str], Any]) -> Any:
+    """
+    Parse the environment variable ``name`` with ``parse``, or None if it is unset. Only read
+    on demand, so a bad value can't break conda when the plugin is loaded.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return None
+    try:
+        return parse(value)
+    except ValueError as exc:
+        raise CondaValueError(f"{name} {exc}") from exc
+
+
+def _zstd_level_from_env() -> int:
+    level = _setting_from_env("CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", _parse_zstd_level)
+    return ZSTD_COMPRESS_LEVEL if level is None else level
+
+
+def _zstd_threads_from_env() -> int | None:
+    return _setting_from_env("CONDA_SUBCHANNEL_ZSTD_THREADS", _parse_zstd_threads)
+
+
 def _fetch_channel(channel, subdirs=None, repodata_fn=REPODATA_FN):
     def fetch(url):
         subdir_data = SubdirData(Channel(url), repodata_fn=repodata_fn)
         subdir_data.load()
         return subdir_data
 
-    with ThreadLimitedThreadPoolExecutor(max_workers=context.fetch_threads) as executor:
-        urls = Channel(channel).urls(with_credentials=True, subdirs=subdirs)
+    urls = Channel(channel).urls(with_credentials=True, subdirs=subdirs)
+    # One worker per subdir URL, even beyond context.fetch_threads: a channel has a handful of
+    # subdirs and each worker mostly waits on the network. conda's session already pools
+    # connections per host, and it downloads repodata.json.zst instead when available.
+    max_workers = max(1, len(urls))
+    with ThreadLimitedThreadPoolExecutor(max_workers=max_workers) as executor:
         return list(executor.map(fetch, urls))
 
 
+class _RecordIndex(dict):
+    """
+    ``name -> [((subdir, fn), record)]`` index over the records of several subdirs, so filters
+    can probe one bucket instead of querying every SubdirData. Buckets are built on first
+    access from the name index each SubdirData already keeps, so only the records of the
+    queried names are turned into ``PackageRecord`` objects.
+    """
+
+    def __init__(self, subdir_datas: Iterable[SubdirData] = ()):
+        super().__init__()
+        self._subdir_datas = list(subdir_datas)
+
+    def __missing__(self, name: str) -> list[tuple[tuple[str, str], PackageRecord]]:
+        self[name] = bucket = [
+            ((sd.channel.subdir, record.fn), record)
+            for sd in self._subdir_datas
+            for record in sd._iter_records_by_name(name)
+        ]
+        return bucket
+
+    def iter_records(self) -> Iterator[tuple[tuple[str, str], PackageRecord]]:
+        """
+        Every ``((subdir, fn), record)`` in the index. Reads the subdirs directly instead of
+        building (and keeping) all the buckets.
+        """
+        if not self._subdir_datas:
+            for bucket in self.values():
+                yield from bucket
+        for sd in self._subdir_datas:
+            subdir = sd.channel.subdir
+            for record in sd.iter_records():
+                yield (subdir, record.fn), record
+
+
+def _query(
+    index: _RecordIndex,
+    spec: MatchSpec,
+    after: int | None = None,
+    before: int | None = None,
+) -> Iterator[tuple[tuple[str, str], PackageRecord]]:
+    name = spec.get_exact_value("name")
+    if name:
+        candidates = index[name]
+    else:
+        # glob or missing name (e.g. 'lib*' or '*'); check every record
+        candidates = index.iter_records()
+    # e.g. a bare 'libgcc-ng' dependency; everything in the bucket matches
+    match = None if name and spec.is_name_only_spec else spec.match
+    # Cheap timestamp comparisons go first so MatchSpec.match only runs on records within range
+    for key, record in candidates:
+        if before is not None and record.timestamp >= before:
+            continue
+        if after is not None and record.timestamp <= after:
+            continue
+        if match is None or match(record):
+            yield key, record
+
+
 def _keep_records(
-    subdir_datas: Iterable[SubdirData],
+    index: _RecordIndex,
     specs: Iterable[MatchSpec],
     after: int | None = None,
     before: int | None = None,
-) -> Iterator[tuple[SubdirData, PackageRecord]]:
+) -> Iterator[tuple[tuple[str, str], PackageRecord]]:
     if specs:
         for spec in specs:
-            for sd in subdir_datas:
-                for record in sd.query(spec):
-                    if before is not None and record.timestamp >= before:
-                        continue
-                    if after is not None and record.timestamp <= after:
-                        continue
-                    yield sd, record
+            yield from _query(index, spec, after, before)
     elif before is not None or after is not None:
-        for sd in subdir_datas:
-            for record in sd.iter_records():
-                if before is not None and record.timestamp >= before:
-                    continue
-                if after is not None and record.timestamp <= after:
-                    continue
-                yield sd, record
+        for key, record in index.iter_records():
+            if before is not None and record.timestamp >= before:
+                continue
+            if after is not None and record.timestamp <= after:
+                continue
+            yield key, record
     else:
         raise ValueError("Must provide at least one truthy 'specs', 'after' or 'before'.")
 
 
+@lru_cache(maxsize=None)
+def _match_spec(spec: str | MatchSpec) -> MatchSpec:
+    # The same dependency strings show up in thousands of records; parse each only once.
+    # MatchSpec objects are immutable, so sharing them is safe.
+    return MatchSpec(spec)
+
+
+def _group_by_name(records: dict[tuple[str, str], PackageRecord]) -> _RecordIndex:
+    # Same layout as the source index, so it can be used with _query()
+    by_name = _RecordIndex()
+    for key, record in records.items():
+        by_name[record.name].append((key, record))
+    return by_name
+
+
 def _reduce_index(
     subdir_datas: Iterable[SubdirData],
     specs_to_keep: Iterable[str | MatchSpec] | None = None,
@@ -79,137 +234,203 @@ def _reduce_index(
     after: int | None = None,
     before: int | None = None,
 ) -> dict[tuple[str, str], PackageRecord]:
-    specs_to_keep = [MatchSpec(spec) for spec in (specs_to_keep or ())]
-    specs_to_remove = [MatchSpec(spec) for spec in (specs_to_remove or ())]
-    specs_to_prune = [MatchSpec(spec) for spec in (specs_to_prune or ())]
-    trees_to_keep = [MatchSpec(spec) for spec in (trees_to_keep or ())]
-    if trees_to_keep or specs_to_keep or after is not None or before is not None:
+    specs_to_keep = [_match_spec(spec) for spec in (specs_to_keep or ())]
+    specs_to_remove = [_match_spec(spec) for spec in (specs_to_remove or ())]
+    specs_to_prune = [_match_spec(spec) for spec in (specs_to_prune or ())]
+    trees_to_keep = [_match_spec(spec) for spec in (trees_to_keep or ())]
+    index = _RecordIndex(subdir_datas)
+    keep_filters = trees_to_keep or specs_to_keep or after is not None or before is not None
+    if keep_filters:
         records = {}
-        names_to_keep = {MatchSpec(spec).name: spec for spec in (*specs_to_keep, *trees_to_keep)}
+        names_to_keep = {spec.name: spec for spec in (*specs_to_keep, *trees_to_keep)}
         if trees_to_keep:
-            specs_from_trees = set()
-            for sd, record in _keep_records(subdir_datas, trees_to_keep, after, before):
-                if (sd.channel.subdir, record.fn) in records:
-                    continue
-                records[(sd.channel.subdir, record.fn)] = record
+            # Each spec is queried at most once, even if it is readded by later records
+            specs_from_trees = deque()
+            seen_specs = set()
+            # Common dependencies (python, libgcc-ng...) show up in most records; skipping the
+            # already seen strings is cheaper than hashing their MatchSpecs again
+            seen_deps = set()
+
+            def add_to_tree(key, record):
+                if key in records:
+                    return
+                # Circular dependencies (python -> pip -> python) would pull records that do not
+                # fit the initially requested spec for that name. This might break solvability,
+                # but in principle the solver should only allow one record per package name in
+                # the solution, so it should be ok to leave them out. IOW, if a requested spec
+                # adds a dependency that ends up depending on the requested spec again, the
+                # initial node should satisfy that and doesn't need the extra ones. Rejecting
+                # them here also avoids expanding their dependencies.
+                if (pin := names_to_keep.get(record.name)) and not pin.match(record):
+                    return
+                records[key] = record
                 for dep in record.depends:
-                    specs_from_trees.add(MatchSpec(dep))
+                    if dep in seen_deps:
+                        continue
+                    seen_deps.add(dep)
+                    spec = _match_spec(dep)
+                    if spec.is_name_only_spec and spec.name in names_to_keep:
+                        # Only the records fitting the requested spec would be accepted anyway
+                        spec = names_to_keep[spec.name]
+                    if spec not in seen_specs:
+                        seen_specs.add(spec)
+                        specs_from_trees.append(spec)
+
+            for key, record in _keep_records(index, trees_to_keep, after, before):
+                add_to_tree(key, record)
 
             # First we filter with the recursive actions
             while specs_from_trees:
-                spec = specs_from_trees.pop()
-                for sd in subdir_datas:
-                    for record in sd.query(spec):
-                        if (sd.channel.subdir, record.fn) in records:
-                            continue
-                        records[(sd.channel.subdir, record.fn)] = record
-                        for dep in record.depends:
-                            # This step might readd dependencies that are not part of the
-                            # requested tree; e.g python=3.9 might add pip, which depends on python,
-                            # which will then appear again. We will clear those later.
-                            specs_from_trees.add(MatchSpec(dep))
-
-        # Remove records added by circular dependencies (python -> pip -> python); this might
-        # break solvability, but in principle the solver should only allow one record per package
-        # name in the solution, so it should be ok to remove name matches that are not fitting the
-        # initially requested spec. IOW, if a requested spec adds a dependency that ends up
-        # depending on the requested spec again, the initial node should satisfy that and doesn't
-        # doesn't need the extra ones.
-        to_remove = []
-        for key, record in records.items():
-            if (spec := names_to_keep.get(record.name)) and not spec.match(record):
-                to_remove.append(key)
-        for key in to_remove:
-            del records[key]
+                spec = specs_from_trees.popleft()
+                for key, record in _query(index, spec):
+                    add_to_tree(key, record)
 
         if specs_to_keep or after is not None or before is not None:
             # Now we also add the slice of non-recursive keeps:
-            for sd, record in _keep_records(subdir_datas, specs_to_keep, after, before):
-                if (sd.channel.subdir, record.fn) in records:
+            for key, record in _keep_records(index, specs_to_keep, after, before):
+                if key in records:
                     continue
-                records[(sd.channel.subdir, record.fn)] = record
+                records[key] = record
     else:
         # No keep filters = We start with _everything_
-        records = {
-            (sd.channel.subdir, record.fn): record
-            for sd in subdir_datas
-            for record in sd.iter_records()
-        }
+        records = dict(index.iter_records())
 
     # Now that we know what to keep, we remove stuff
     to_remove = set()
+    if not keep_filters:
+        # The source index already groups exactly these records
+        by_name = index
+    elif specs_to_prune or specs_to_remove:
+        by_name = _group_by_name(records)
+    else:
+        by_name = _RecordIndex()
 
     # Of the packages that survived the keeping, we will remove the ones that do not match the
-    # prune filter
+    # prune filter; records with a different name are ignored
     for spec in specs_to_prune:
-        for key, record in records.items():
-            if spec.name != record.name:
-                continue  # ignore if the name doesn't match
+        for key, record in by_name[spec.name]:
             if not spec.match(record):
                 to_remove.add(key)
 
-    # These are the explicit removals; if you match this, you are out
+    # These are the explicit removals; if you match this, you are out. Name-only specs (the
+    # common '--remove python') drop their whole bucket without calling MatchSpec.match, and
+    # only specs with glob names (e.g. 'lib*') need to look at every record.
     for spec in specs_to_remove:
-        for key, record in records.items():
-            if spec.match(record):
-                to_remove.add(key)
-    
-    for key in to_remove:
-        records.pop(key)
+        to_remove.update(key for key, _ in _query(by_name, spec))
+
+    if len(to_remove) > len(records) // 4:
+        # Dicts don't shrink on deletion; rebuilding is cheaper and leaves a compact table
+        records = {key: record for key, record in records.items() if key not in to_remove}
+    else:
+        for key in to_remove:
+            records.pop(key)
 
     return records
 
 
+@lru_cache(maxsize=None)
+def _dump_fields(record_type: type[PackageRecord]) -> tuple[tuple[str, Any], ...]:
+    return tuple((key, record_type.__fields__[key]) for key in REPODATA_RECORD_KEYS)
+
+
+def _dump_record(record: PackageRecord) -> dict[str, Any]:
+    """
+    Equivalent to ``record.dump()`` restricted to ``REPODATA_RECORD_KEYS``, so the rest of the
+    fields (some of them computed, like ``url`` or ``channel``) are never serialized.
+    """
+    record_type = type(record)
+    dumped = {}
+    for key, field in _dump_fields(record_type):
+        value = getattr(record, key, NULL)
+        if value is NULL or (value is field.default and not field.default_in_dump):
+            continue
+        dumped[key] = field.dump(record, record_type, value)
+    return dumped
+
+
 def _dump_records(
     records: dict[tuple[str, str], PackageRecord], base_url: str
 ) -> dict[str, dict[str, Any]]:
-    repodatas = {}
-    record_keys = (
-        "build",
-        "build_number",
-        "constrains",
-        "depends",
-        "license",
-        "md5",
-        "name",
-        "sha256",
-        "size",
-        "subdir",
-        "timestamp",
-        "version",
-    )
-    for (subdir, filename), record in records.items():
-        if subdir not in repodatas:
-            repodatas[subdir] = {
-                "repodata_version": 2,
-                "info": {
-                    "base_url": base_url,
-                    "subdir": subdir,
-                },
-                "packages": {},
-                "packages.conda": {},
-                "removed": [],
-            }
-        key = "packages.conda" if record.fn.endswith(".conda") else "packages"
-        dumped = record.dump()
-        repodatas[record.subdir][key][filename] = {
-            key: dumped[key] for key in record_keys if key in dumped
+    # Everything is inserted in sorted key order so the output doesn't need to be sorted
+    # again (for every nested dict) when serialized
+    repodatas = {
+        subdir: {
+            "info": {
+                "base_url": base_url,
+                "subdir": subdir,
+            },
+            "packages": {},
+            "packages.conda": {},
+            "removed": [],
+            "repodata_version": 2,
         }
+        for subdir in sorted({subdir for subdir, _ in records})
+    }
+    for (subdir, filename), record in sorted(records.items(), key=lambda item: item[0]):
+        key = "packages.conda" if filename.endswith(".conda") else "packages"
+        repodatas[subdir][key][filename] = _dump_record(record)
     return repodatas
 
 
-def _checksum(path, algorithm, buffersize=65536):
-    hash_impl = getattr(hashlib, algorithm)()
+def _checksums(path, algorithms=("sha256", "md5")):
+    """
+    Compute several hexdigests of ``path``. The file is memory-mapped so each hash consumes it
+    in a single call (which releases the GIL) instead of a Python-level read loop.
+    """
     with open(path, "rb") as f:
-        for block in iter(lambda: f.read(buffersize), b""):
-            hash_impl.update(block)
-    return hash_impl.hexdigest()
+        if not os.fstat(f.fileno()).st_size:
+            return [hashlib.new(algorithm).hexdigest() for algorithm in algorithms]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            digests = [hashlib.new(algorithm, data).hexdigest() for algorithm in algorithms]
+        _release_page_cache(f)
+        return digests
+
+
+def _release_page_cache(fo):
+    """
+    Hint the kernel that the file open in ``fo`` won't be read again, so the (possibly large)
+    output files don't evict more useful pages. Written data must have been synced first, or
+    its dirty pages are kept. Only effective where ``posix_fadvise`` is available.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fo.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _sync_file(fo):
+    fo.flush()
+    os.fsync(fo.fileno())
+
+
+def _fsync_directory(path):
+    """
+    Persist the directory entries of ``path`` (e.g. after renames). Directories can't be
+    opened for this on Windows, where it is skipped.
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=None)
+def _template(name: str) -> jinja2.Template:
+    # Templates are compiled once per process instead of once per subdir
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATES_DIR), auto_reload=False
+    )
+    return environment.get_template(name)
+
+
+@lru_cache(maxsize=None)
+def _static_file(name: str) -> str:
+    return (TEMPLATES_DIR / name).read_text()
 
 
 def _write_channel_index_html(source_channel: Channel, channel_path: Path, cli_flags: dict[str, Any], served_at: str | None = None):
-    templates_dir = Path(__file__).parent / "templates"
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
-    template = environment.get_template("channel.j2.html")
+    template = _template("channel.j2.html")
     channel_path = Path(channel_path)
     content = template.render(
         subchannel_name=channel_path.name,
@@ -220,20 +441,42 @@ def _write_channel_index_html(source_channel: Channel, channel_path: Path, cli_f
         subchannel_url=served_at or "",
     )
     (channel_path / "index.html").write_text(content)
-    (channel_path / "style.css").write_text((templates_dir / "style.css").read_text())
+    (channel_path / "style.css").write_text(_static_file("style.css"))
 
 
-def _write_subdir_index_html(subdir_path: Path, served_at: str | None = None):
-    templates_dir = Path(__file__).parent / "templates"
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
-    template = environment.get_template("subdir.j2.html")
+def _write_subdir_index_html(
+    subdir_path: Path,
+    served_at: str | None = None,
+    checksums: dict[str, tuple[str, str]] | None = None,
+    repodata: dict[str, Any] | None = None,
+):
+    """
+    Render ``index.html`` for ``subdir_path``. ``checksums`` maps filenames to their known
+    ``(sha256, md5)``, e.g. computed while writing them; other files are read back and hashed.
+    ``repodata`` is the content of its ``repodata.json``, which is parsed from disk if omitted.
+    """
+    checksums = checksums or {}
+    template = _template("subdir.j2.html")
     repodatas = []
     packages = []
     base_url = None
-    for path in sorted(subdir_path.glob("*")):
-        if path.name in ("index.md", "index.html"):
-            continue
-        stat = path.stat()
+    # DirEntry.stat() reuses the information obtained while listing the directory
+    with os.scandir(subdir_path) as it:
+        entries = sorted(
+            (
+                entry
+                for entry in it
+                if entry.name not in ("index.md", "index.html") and not entry.name.startswith(".")
+            ),
+            key=lambda entry: entry.name,
+        )
+    for entry in entries:
+        path = Path(entry.path)
+        stat = entry.stat()
+        if path.name in checksums:
+            sha256, md5 = checksums[path.name]
+        else:
+            sha256, md5 = _checksums(path, ("sha256", "md5"))
         url = "/".join([served_at, subdir_path.name, path.name]) if served_at else path.name
         repodatas.append(
             {
@@ -241,18 +484,17 @@ def _write_subdir_index_html(subdir_path: Path, served_at: str | None = None):
                 "url": url,
                 "size": stat.st_size,
                 "last_modified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
-                "sha256": _checksum(path, "sha256"),
-                "md5": _checksum(path, "md5"),
+                "sha256": sha256,
+                "md5": md5,
             }
         )
-        if path.name == "repodata.json":
-            repodata = json.loads(path.read_text())
-            if repodata:
-                base_url = repodata["info"]["base_url"]
-                for key in ("packages", "packages.conda"):
-                    for filename in repodata.get(key, ()):
-                        packages.append(filename)
+        if path.name == "repodata.json" and repodata is None:
+            repodata = _load_json(path)
 
+    if repodata:
+        base_url = repodata["info"]["base_url"]
+        for key in ("packages", "packages.conda"):
+            packages.extend(repodata.get(key, ()))
     packages.sort(key=_sortkey_package_filenames)
     content = template.render(
         subchannel_name=subdir_path.parent.name,
@@ -266,44 +508,330 @@ def _write_subdir_index_html(subdir_path: Path, served_at: str | None = None):
     (subdir_path / "index.html").write_text(content)
 
 
+def _load_json(path: Path) -> Any:
+    data = path.read_bytes()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _iter_json_pieces(obj: Any, encode: Callable[[Any], str], depth: int = 2) -> Iterator[str]:
+    """
+    Stream the outer ``depth`` levels of nested dicts (repodata -> packages -> filename) and
+    encode everything below that in one go with ``encode``.
+    """
+    if depth == 0 or not isinstance(obj, dict):
+        yield encode(obj)
+        return
+    yield "{"
+    for index, (key, value) in enumerate(obj.items()):
+        yield f"{',' if index else ''}{encode(key)}:"
+        yield from _iter_json_pieces(value, encode, depth - 1)
+    yield "}"
+
+
+def _iter_json_chunks(obj: Any, chunksize: int = WRITE_BUFFER_SIZE) -> Iterator[bytes]:
+    """
+    Encode ``obj`` as compact JSON and yield it as UTF-8 chunks of roughly ``chunksize``
+    bytes. Keys are not sorted; see ``_dump_records``. With ``orjson`` the document is encoded
+    in one go in C and then sliced; otherwise it is streamed record by record with the C
+    accelerated stdlib encoder, so the full string is never built.
+    """
+    if orjson is not None:
+        data = memoryview(orjson.dumps(obj))
+        for offset in range(0, len(data), chunksize):
+            yield data[offset : offset + chunksize]
+        return
+
+    # Non-ASCII characters are written as UTF-8, like orjson does, so the output is the same
+    # byte for byte with or without it
+    encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    buffer = []
+    size = 0
+    for piece in _iter_json_pieces(obj, encode):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunksize:
+            yield "".join(buffer).encode("utf-8")
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+class _HashingWriter:
+    """
+    Minimal binary file wrapper that computes sha256 and md5 of everything written through it.
+    """
+
+    def __init__(self, fo):
+        self._fo = fo
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+
+    def write(self, data) -> int:
+        self._sha256.update(data)
+        self._md5.update(data)
+        return self._fo.write(data)
+
+    def flush(self):
+        self._fo.flush()
+
+    def close(self):
+        self._fo.close()
+
+    def hexdigests(self) -> tuple[str, str]:
+        return self._sha256.hexdigest(), self._md5.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _zstd_compressor(
+    level: int = ZSTD_COMPRESS_LEVEL, threads: int = ZSTD_COMPRESS_THREADS
+) -> zstandard.ZstdCompressor:
+    # One compressor (and its worker threads) per process, reused across subdirs
+    return zstandard.ZstdCompressor(level=level, threads=threads)
+
+
+def _output_settings(outputs: Iterable[str], zstd_level: int) -> dict[str, dict[str, Any]]:
+    """
+    Map each file written for ``outputs`` to the settings it is written with. repodata.json goes
+    last, so it is replaced after its compressed variants.
+    """
+    settings = {}
+    if "bz2" in outputs:
+        settings["repodata.json.bz2"] = {"level": BZ2_COMPRESS_LEVEL}
+    if "zstd" in outputs:
+        settings["repodata.json.zst"] = {"level": zstd_level}
+    settings["repodata.json"] = {}
+    return settings
+
+
+def _load_state(path: Path) -> dict[str, Any]:
+    try:
+        state = _load_json(path)
+    except (OSError, ValueError):  # missing or corrupted; everything will be rewritten
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def _is_up_to_date(path: Path, entry: dict[str, Any] | None, source: str, settings: dict) -> bool:
+    if not entry or entry.get("source") != source or entry.get("settings") != settings:
+        return False
+    try:
+        return path.stat().st_size == entry.get("size")
+    except OSError:
+        return False
+
+
+def _write_outputs(
+    targets: list[Path],
+    chunks: list[bytes],
+    size: int,
+    zstd_level: int = ZSTD_COMPRESS_LEVEL,
+    zstd_threads: int = ZSTD_COMPRESS_THREADS,
+) -> dict[str, tuple[str, str]]:
+    """
+    Write ``chunks`` to the ``.tmp`` file of each target, compressed according to its suffix,
+    in a single pass. Returns the ``(sha256, md5)`` of each file, hashed on the way to disk.
+    """
+    if not targets:
+        return {}
+    with ExitStack() as stack:
+        writers = []
+        hashing_fos = {}
+        for target in targets:
+            fo = stack.enter_context(open(f"{target}.tmp", "wb", buffering=WRITE_BUFFER_SIZE))
+            # Run after the compressor below is closed and before the file is: the data is on
+            # disk before the file is renamed into place, and then dropped from the page cache
+            stack.callback(_release_page_cache, fo)
+            stack.callback(_sync_file, fo)
+            fo = hashing_fos[target.name] = _HashingWriter(fo)
+            if target.suffix == ".bz2":
+                writer = stack.enter_context(
+                    bz2.BZ2File(fo, "wb", compresslevel=BZ2_COMPRESS_LEVEL)
+                )
+            elif target.suffix == ".zst":
+                # Record the content size in the frame header, like .compress() does, so
+                # clients can decompress it in one go
+                writer = stack.enter_context(
+                    _zstd_compressor(zstd_level, zstd_threads).stream_writer(
+                        fo, size=size, closefd=False
+                    )
+                )
+            else:
+                writer = fo
+            writers.append(writer)
+        # bz2 and zstd release the GIL while compressing, so each output is fed from its own
+        # thread: a chunk takes as long as the slowest codec, not the sum of all of them.
+        # Writes to each output stay in order because a chunk is only submitted once the
+        # previous one has been written everywhere.
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=len(writers)))
+        pending = []
+        for chunk in chunks:
+            for future in pending:
+                future.result()
+            pending = [executor.submit(writer.write, chunk) for writer in writers]
+        for future in pending:
+            future.result()
+    return {name: hashing_fo.hexdigests() for name, hashing_fo in hashing_fos.items()}
+
+
+def _write_repodata(
+    subdir: str,
+    repodata: dict[str, Any],
+    path: Path,
+    outputs: Iterable[str] = ("zstd",),
+    zstd_level: int = ZSTD_COMPRESS_LEVEL,
+    zstd_threads: int = ZSTD_COMPRESS_THREADS,
+) -> dict[str, tuple[str, str]]:
+    """
+    Write ``repodata.json`` and its compressed variants for ``subdir``.
+
+    The digest of the JSON and the settings each file was written with are recorded in
+    ``REPODATA_STATE_FN``, next to the outputs. Files that state still vouches for (e.g. when a
+    subchannel is regenerated periodically without changes) are neither compressed nor written
+    again, and keep their mtime. Each file is written under a temporary name and then replaced
+    atomically, one at a time; the state is only updated once all of them are in place, so a
+    run interrupted halfway can leave mismatched files until the next run rewrites them.
+
+    Returns the ``(sha256, md5)`` of each output file.
+    """
+    subdir_path = path / subdir
+    subdir_path.mkdir(parents=True, exist_ok=True)
+    # The encoded document is kept in memory (orjson builds it in one go anyway), so its digest
+    # and size are known before writing, and every output is written in the same pass
+    chunks = list(_iter_json_chunks(repodata))
+    size = sum(len(chunk) for chunk in chunks)
+    source = hashlib.sha256()
+    for chunk in chunks:
+        source.update(chunk)
+    source = source.hexdigest()
+
+    state_path = subdir_path / REPODATA_STATE_FN
+    state = _load_state(state_path)
+    settings = _output_settings(outputs, zstd_level)
+    removed = False
+    for name in ("repodata.json.bz2", "repodata.json.zst"):
+        if name not in settings:
+            # Don't leave behind outputs of previous runs that would no longer match
+            (subdir_path / name).unlink(missing_ok=True)
+            removed |= state.pop(name, None) is not None
+
+    checksums = {}
+    targets = []
+    for name, file_settings in settings.items():
+        entry = state.get(name)
+        if _is_up_to_date(subdir_path / name, entry, source, file_settings):
+            checksums[name] = entry["sha256"], entry["md5"]
+        else:
+            targets.append(subdir_path / name)
+    if not targets and not removed:
+        return checksums
+
+    written = _write_outputs(targets, chunks, size, zstd_level, zstd_threads)
+    for target in targets:
+        os.replace(f"{target}.tmp", target)
+        sha256, md5 = checksums[target.name] = written[target.name]
+        state[target.name] = {
+            "source": source,
+            "settings": settings[target.name],
+            "size": target.stat().st_size,
+            "sha256": sha256,
+            "md5": md5,
+        }
+    with open(f"{state_path}.tmp", "w") as fo:
+        json.dump(state, fo, indent=2, sort_keys=True)
+        _sync_file(fo)
+    os.replace(f"{state_path}.tmp", state_path)
+    # Every file was synced before its rename; one sync of the directory persists the renames
+    _fsync_directory(subdir_path)
+    return checksums
+
+
+def _write_subdir(
+    subdir: str,
+    repodata: dict[str, Any],
+    path: Path,
+    served_at: str | None = None,
+    outputs: Iterable[str] = ("zstd",),
+    zstd_level: int = ZSTD_COMPRESS_LEVEL,
+    zstd_threads: int = ZSTD_COMPRESS_THREADS,
+):
+    checksums = _write_repodata(subdir, repodata, path, outputs, zstd_level, zstd_threads)
+    _write_subdir_index_html(path / subdir, served_at, checksums, repodata)
+
+
 def _write_to_disk(
     source_channel: Channel | str,
     repodatas: dict[str, dict[str, Any]],
     path: os.PathLike | str,
     cli_flags: dict[str, Any],
     served_at: str | None = None,
-    outputs: Iterable[str] = ("bz2", "zstd"),
+    outputs: Iterable[str] = ("zstd",),
+    zstd_level: int = ZSTD_COMPRESS_LEVEL,
+    zstd_threads: int | None = None,
 ):
+    """
+    Write the subchannel for ``repodatas`` to ``path``. ``zstd_threads`` defaults to
+    ``ZSTD_COMPRESS_THREADS`` when subdirs are written one at a time, and to 0 when they are
+    written in parallel processes.
+    """
     path = Path(path)
     path.mkdir(parents=True, exist_ok=True)
-    for subdir, repodata in repodatas.items():
-        (path / subdir).mkdir(parents=True, exist_ok=True)
-        repodata_json = path / subdir / "repodata.json"
-        json_contents = json.dumps(repodata, indent=2, sort_keys=True)
-        repodata_json.write_text(json_contents)
-        if "bz2" in outputs:
-            # Create compressed BZ2
-            with open(str(repodata_json) + ".bz2", "wb") as fo:
-                fo.write(bz2.compress(json_contents.encode("utf-8")))
-        if "zstd" in outputs:
-            # Create compressed ZSTD
-            with open(str(repodata_json) + ".zst", "wb") as fo:
-                repodata_zst_content = zstandard.ZstdCompressor(
-                    level=ZSTD_COMPRESS_LEVEL, threads=ZSTD_COMPRESS_THREADS
-                ).compress(json_contents.encode("utf-8"))
-                fo.write(repodata_zst_content)
-        _write_subdir_index_html(path / subdir, served_at)
-
-    # noarch must always be present
-    noarch_repodata = path / "noarch" / "repodata.json"
-    if not noarch_repodata.is_file():
-        noarch_repodata.parent.mkdir(parents=True, exist_ok=True)
-        noarch_repodata.write_text("{}")
-        _write_subdir_index_html(path / "noarch", served_at)
+    # Serialization and compression are CPU bound and independent per subdir
+    max_workers = min(len(repodatas), os.cpu_count() or 1)
+    if max_workers > 1:
+        # Subdirs already use every core; unless explicitly requested, don't oversubscribe
+        # them with zstd worker threads on top
+        if zstd_threads is None:
+            zstd_threads = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _write_subdir,
+                    subdir,
+                    repodata,
+                    path,
+                    served_at,
+                    outputs,
+                    zstd_level,
+                    zstd_threads,
+                )
+                for subdir, repodata in repodatas.items()
+            ]
+            for future in as_completed(futures):
+                future.result()  # re-raise errors from the workers
+    else:
+        if zstd_threads is None:
+            zstd_threads = ZSTD_COMPRESS_THREADS
+        # Render index.html (and hash any file we did not write) in the background while the
+        # next subdir is being compressed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            futures = []
+            for subdir, repodata in repodatas.items():
+                checksums = _write_repodata(
+                    subdir, repodata, path, outputs, zstd_level, zstd_threads
+                )
+                futures.append(
+                    executor.submit(
+                        _write_subdir_index_html, path / subdir, served_at, checksums, repodata
+                    )
+                )
+            for future in futures:
+                future.result()
+
+    # noarch must always be present. Write the placeholder like any other subdir, so the
+    # compressed files of a previous run can't shadow it.
+    if "noarch" not in repodatas:
+        _write_subdir("noarch", {}, path, served_at, outputs, zstd_level, zstd_threads)
 
     _write_channel_index_html(Channel(source_channel), path, cli_flags, served_at)
 
 
+@lru_cache(maxsize=None)
+def _version_order(version: str) -> VersionOrder:
+    # Many builds share a version; parse each one once
+    return VersionOrder(version)
+
+
 def _sortkey_package_filenames(fn: str):
     basename, ext = os.path.splitext(fn)
     name, version, build = basename.rsplit("-", 2)
@@ -313,4 +841,4 @@ def _sortkey_package_filenames(fn: str):
             if field.isdigit():
                 build_number = field
                 break
-    return name, VersionOrder(version), build_number, ext
\ No newline at end of file
+    return name, _version_order(version), build_number, ext
\ No newline at end of file
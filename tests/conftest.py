@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+from conda.base.context import context, reset_context
+from conda.core.subdir_data import SubdirData
+from conda.models.channel import Channel
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-integration",
+        action="store_true",
+        default=False,
+        help="Run the tests that need network access to conda-forge.",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "integration: requires network access to conda-forge")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-integration"):
+        return
+    skip = pytest.mark.skip(reason="needs --run-integration")
+    for item in items:
+        if "integration" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def fake_channel():
+    """
+    A tiny local channel with a few python, nodejs and dependency records spread across
+    2016, 2023 and 2024, so filters can be tested without downloading conda-forge.
+    """
+    return str(Path(__file__).parent / "data" / "fake-channel")
+
+
+@pytest.fixture(scope="session")
+def conda_forge():
+    """
+    Fetch conda-forge's repodata once per test session. Later loads in the same session are
+    served from conda's on-disk cache without revalidating it over the network.
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("CONDA_LOCAL_REPODATA_TTL", str(24 * 60 * 60))
+        reset_context()
+        for subdir in context.subdir, "noarch":
+            SubdirData(Channel(f"conda-forge/{subdir}")).load()
+        yield "conda-forge"
+    reset_context()
@@ -0,0 +1,124 @@
+import argparse
+import os
+
+import pytest
+from conda.exceptions import CondaValueError
+
+from conda_subchannel import core
+from conda_subchannel.cli import zstd_level_argument
+from conda_subchannel.core import (
+    REPODATA_STATE_FN,
+    ZSTD_COMPRESS_LEVEL,
+    _iter_json_chunks,
+    _write_repodata,
+    _zstd_level_from_env,
+    _zstd_threads_from_env,
+)
+
+OLD_MTIME_NS = 1_000_000_000 * 10**9
+
+
+@pytest.fixture
+def repodata():
+    return {
+        "info": {"subdir": "linux-64"},
+        "packages": {
+            f"pkg-1.0.{i}-0.tar.bz2": {"name": "pkg", "version": f"1.0.{i}", "build": "0"}
+            for i in range(5000)
+        },
+        "packages.conda": {},
+        "removed": [],
+        "repodata_version": 2,
+    }
+
+
+def _age_files(subdir_path):
+    # Make rewrites detectable regardless of the filesystem timestamp resolution
+    for path in subdir_path.iterdir():
+        os.utime(path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("unexpected compression")
+
+
+def test_write_repodata_unchanged(monkeypatch, tmp_path, repodata):
+    subdir_path = tmp_path / "linux-64"
+    checksums = _write_repodata("linux-64", repodata, tmp_path, ("bz2", "zstd"), zstd_threads=0)
+    _age_files(subdir_path)
+
+    monkeypatch.setattr(core.bz2, "BZ2File", _fail)
+    monkeypatch.setattr(core, "_zstd_compressor", _fail)
+    rerun = _write_repodata("linux-64", repodata, tmp_path, ("bz2", "zstd"), zstd_threads=0)
+    assert rerun == checksums
+    assert sorted(path.name for path in subdir_path.iterdir()) == [
+        REPODATA_STATE_FN,
+        "repodata.json",
+        "repodata.json.bz2",
+        "repodata.json.zst",
+    ]
+    for path in subdir_path.iterdir():
+        assert path.stat().st_mtime_ns == OLD_MTIME_NS, path.name
+
+
+def test_write_repodata_new_zstd_level(tmp_path, repodata):
+    subdir_path = tmp_path / "linux-64"
+    zst = subdir_path / "repodata.json.zst"
+    _write_repodata("linux-64", repodata, tmp_path, zstd_level=1, zstd_threads=0)
+    previous = zst.read_bytes()
+    _age_files(subdir_path)
+
+    _write_repodata("linux-64", repodata, tmp_path, zstd_level=19, zstd_threads=0)
+    assert zst.read_bytes() != previous
+    # The JSON itself didn't change
+    assert (subdir_path / "repodata.json").stat().st_mtime_ns == OLD_MTIME_NS
+    assert not list(subdir_path.glob("*.tmp"))
+
+
+def test_zstd_settings_from_env(monkeypatch):
+    monkeypatch.delenv("CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", raising=False)
+    monkeypatch.delenv("CONDA_SUBCHANNEL_ZSTD_THREADS", raising=False)
+    assert _zstd_level_from_env() == ZSTD_COMPRESS_LEVEL
+    assert _zstd_threads_from_env() is None
+
+    monkeypatch.setenv("CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", "19")
+    monkeypatch.setenv("CONDA_SUBCHANNEL_ZSTD_THREADS", "0")
+    assert _zstd_level_from_env() == 19
+    assert _zstd_threads_from_env() == 0
+
+
+@pytest.mark.parametrize(
+    "getter,name,value",
+    (
+        (_zstd_level_from_env, "CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", "23"),
+        (_zstd_level_from_env, "CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", "fast"),
+        (_zstd_threads_from_env, "CONDA_SUBCHANNEL_ZSTD_THREADS", "-2"),
+        (_zstd_threads_from_env, "CONDA_SUBCHANNEL_ZSTD_THREADS", "many"),
+    ),
+)
+def test_bad_zstd_settings_from_env(monkeypatch, getter, name, value):
+    monkeypatch.setenv(name, value)
+    with pytest.raises(CondaValueError, match=name):
+        getter()
+
+
+@pytest.mark.parametrize("value", ("0", "23", "fast"))
+def test_zstd_level_errors_match(monkeypatch, value):
+    monkeypatch.setenv("CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL", value)
+    with pytest.raises(CondaValueError) as env_error:
+        _zstd_level_from_env()
+    with pytest.raises(argparse.ArgumentTypeError) as cli_error:
+        zstd_level_argument(value)
+    # Both come from the same validator
+    assert str(env_error.value) == f"CONDA_SUBCHANNEL_ZSTD_COMPRESS_LEVEL {cli_error.value}"
+
+
+def test_json_fallback_matches_orjson(monkeypatch, repodata):
+    pytest.importorskip("orjson")
+    repodata["packages"]["pkg-1.0.0-0.tar.bz2"].update(
+        license="Ünïcödé ©", depends=["dep >=1.0", "other"], description='quote " and \\'
+    )
+    with_orjson = b"".join(_iter_json_chunks(repodata, chunksize=1000))
+    monkeypatch.setattr(core, "orjson", None)
+    without_orjson = b"".join(_iter_json_chunks(repodata, chunksize=1000))
+    assert without_orjson == with_orjson
@@ -1,8 +1,9 @@
+import argparse
 from datetime import datetime, timezone
 
 import pytest
 
-from conda_subchannel.cli import date_argument
+from conda_subchannel.cli import date_argument, zstd_level_argument
 
 
 @pytest.mark.parametrize("inp,out",
@@ -14,6 +15,8 @@ from conda_subchannel.cli import date_argument
         ["2024-01", datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()],
         ["2024-1", datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()],
         ["2024-1-1-0-0-0", datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()],
+        ["2024-01-01T12:30:00", datetime(2024, 1, 1, 12, 30, tzinfo=timezone.utc).timestamp()],
+        ["2024-01-01T12:30", datetime(2024, 1, 1, 12, 30, tzinfo=timezone.utc).timestamp()],
     )                         
 )
 def test_date_argument(inp, out):
@@ -26,8 +29,28 @@ def test_date_argument(inp, out):
         "-1",
         "ts:abc",
         "ts:2024-1",
+        "ts:nan",
+        "ts:inf",
+        "ts:-inf",
+        "ts:-1",
+        "ts:1e20",
+        # Only parsed by datetime.fromisoformat() on Python 3.11+
+        "20240101",
+        "2024W01",
+        "2024-01-01T12",
     )                         
 )
 def test_bad_date_argument(inp):
     with pytest.raises(ValueError):
         date_argument(inp)
+
+
+@pytest.mark.parametrize("inp,out", (["1", 1], ["3", 3], ["22", 22]))
+def test_zstd_level_argument(inp, out):
+    assert zstd_level_argument(inp) == out
+
+
+@pytest.mark.parametrize("inp", ("0", "23", "-1", "abc"))
+def test_bad_zstd_level_argument(inp):
+    with pytest.raises(argparse.ArgumentTypeError):
+        zstd_level_argument(inp)
@@ -1,237 +1,131 @@
+import bz2
+import hashlib
 import json
-import sys
+import os
+import re
 from datetime import datetime, timezone
 
 import pytest
+import zstandard
 from conda.base.context import context
-from conda.core.subdir_data import SubdirData
-from conda.models.channel import Channel
-from conda.models.match_spec import MatchSpec
 from conda.exceptions import ArgumentError, DryRunExit, PackagesNotFoundError
 from conda.testing import conda_cli  # noqa
 
+from conda_subchannel.core import REPODATA_STATE_FN
 
-def test_noop(conda_cli):
-    with pytest.raises(ArgumentError, match="Please provide at least one filter."):
-        out, err, rc = conda_cli("subchannel", "-c", "conda-forge")
+TS_2017 = datetime(2017, 1, 1, tzinfo=timezone.utc).timestamp()
+TS_2023 = datetime(2023, 1, 1, tzinfo=timezone.utc).timestamp()
+TS_2024 = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
 
 
-def test_noop_star(conda_cli):
-    out, err, rc = conda_cli("subchannel", "-c", "conda-forge", "--keep", "*")
-    assert rc == 1
-    assert "Didn't filter any records" in out
+def _load_records(subdir_path):
+    # Raw dicts are enough for the checks; no need to build PackageRecords via SubdirData.
+    # Note timestamps are in milliseconds here.
+    repodata = json.loads((subdir_path / "repodata.json").read_bytes())
+    return [
+        *repodata.get("packages", {}).values(),
+        *repodata.get("packages.conda", {}).values(),
+    ]
 
 
-def test_only_python(conda_cli, tmp_path):
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--keep",
-        "python",
-        "--output",
-        tmp_path,
+def _subchannel(conda_cli, channel, *args, expected_rc=0):
+    out, err, rc = conda_cli("subchannel", "-c", channel, *args)
+    assert rc == expected_rc, f"stdout:\n{out}\nstderr:\n{err}"
+    return out
+
+
+def _dry_run_create(conda_cli, channel_path, spec):
+    conda_cli(
+        "create",
+        "--dry-run",
+        "-n",
+        "unused",
+        "--override-channels",
+        "--channel",
+        channel_path,
+        spec,
     )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    for subdir in context.subdir, "noarch":
-        if (tmp_path / subdir / "repodata.json").is_file():
-            tested += 1
-            channel = Channel(str(tmp_path / subdir))
-            sd = SubdirData(channel)
-            sd.load()
-            assert all(rec.name == "python" for rec in sd.iter_records())
-    assert tested
 
 
-def test_python_tree(conda_cli, tmp_path):
+def test_noop(conda_cli, fake_channel):
+    with pytest.raises(ArgumentError, match="Please provide at least one filter."):
+        out, err, rc = conda_cli("subchannel", "-c", fake_channel)
+
+
+def test_noop_star(conda_cli, fake_channel):
+    out = _subchannel(
+        conda_cli, fake_channel, "--platform", "noarch", "--keep", "*", expected_rc=1
+    )
+    assert "Didn't filter any records" in out
+
+
+@pytest.mark.parametrize(
+    "args,check",
+    (
+        pytest.param(
+            ("--keep", "python"),
+            lambda rec: rec["name"] == "python",
+            id="only-python",
+        ),
+        pytest.param(
+            ("--remove", "python"),
+            lambda rec: rec["name"] != "python",
+            id="not-python",
+        ),
+        pytest.param(
+            ("--after", "2024"),
+            lambda rec: rec["timestamp"] / 1000 >= TS_2024,
+            id="only-after",
+        ),
+        pytest.param(
+            ("--before", "2017", "--platform", "osx-64"),
+            lambda rec: rec["timestamp"] / 1000 <= TS_2017,
+            id="only-before",
+        ),
+        pytest.param(
+            ("--after", "2023", "--before", "2024", "--platform", "linux-64"),
+            lambda rec: TS_2023 <= rec["timestamp"] / 1000 <= TS_2024,
+            id="between-dates",
+        ),
+    ),
+)
+def test_filter(conda_cli, tmp_path, fake_channel, args, check):
+    _subchannel(conda_cli, fake_channel, *args, "--output", tmp_path)
+    # Check every subdir that was written, not only the native one
+    subdirs = [entry.name for entry in os.scandir(tmp_path) if entry.is_dir()]
+    assert subdirs
+    for subdir in subdirs:
+        assert all(check(rec) for rec in _load_records(tmp_path / subdir))
+
+
+def test_python_tree(conda_cli, tmp_path, fake_channel):
     spec = "python=3.9"
     channel_path = tmp_path / "channel"
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--keep-tree",
-        spec,
-        "--output",
-        channel_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    tested += 1
-    channel = Channel(str(channel_path / context.subdir))
-    sd = SubdirData(channel)
-    sd.load()
+    _subchannel(conda_cli, fake_channel, "--keep-tree", spec, "--output", channel_path)
     python_count = 0
-    other_count = 0
-    py39 = MatchSpec(spec)
-    for record in sd.iter_records():  # we should see Python and their dependencies
-        if record.name == "python":
-            assert py39.match(record)
+    other_names = set()
+    for record in _load_records(channel_path / context.subdir):  # Python and its dependencies
+        if record["name"] == "python":
+            # We didn't take Python 3.10 in the subchannel
+            assert record["version"].startswith("3.9.")
             python_count += 1
         else:
-            other_count += 1
+            other_names.add(record["name"])
     assert python_count
-    assert other_count
+    assert other_names
+    # nodejs doesn't match python=3.9, so it must be out
+    assert "nodejs" not in other_names
 
     # This should be solvable
     with pytest.raises(DryRunExit):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "python=3.9",
-        )
+        _dry_run_create(conda_cli, channel_path, "python=3.9")
 
-    # This should be unsolvable, we didn't take Python 3.10 in the subchannel
-    with pytest.raises(PackagesNotFoundError):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "python=3.10",
-        )
-
-    # This should fail too; nodejs doesn't match python=3.9, so it must be out
-    with pytest.raises(PackagesNotFoundError):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "nodejs",
-        )
-
-
-def test_not_python(conda_cli, tmp_path):
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--remove",
-        "python",
-        "--output",
-        tmp_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    for subdir in context.subdir, "noarch":
-        if (tmp_path / subdir / "repodata.json").is_file():
-            tested += 1
-            channel = Channel(str(tmp_path / subdir))
-            sd = SubdirData(channel)
-            sd.load()
-            assert not [rec for rec in sd.iter_records() if rec.name == "python"]
-    assert tested
-
-
-def test_only_after(conda_cli, tmp_path):
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--after",
-        "2024",
-        "--output",
-        tmp_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    timestamp_2024 = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
-    for subdir in context.subdir, "noarch":
-        if (tmp_path / subdir / "repodata.json").is_file():
-            tested += 1
-            channel = Channel(str(tmp_path / subdir))
-            sd = SubdirData(channel)
-            sd.load()
-            assert all(rec.timestamp >= timestamp_2024 for rec in sd.iter_records())
-    assert tested
-
-
-def test_only_before(conda_cli, tmp_path):
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--before",
-        "2017",
-        "--platform",
-        "osx-64",
-        "--output",
-        tmp_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    timestamp_2024 = datetime(2017, 1, 1, tzinfo=timezone.utc).timestamp()
-    for subdir in context.subdir, "noarch":
-        if (tmp_path / subdir / "repodata.json").is_file():
-            tested += 1
-            channel = Channel(str(tmp_path / subdir))
-            sd = SubdirData(channel)
-            sd.load()
-            assert all(rec.timestamp <= timestamp_2024 for rec in sd.iter_records())
-    assert tested
-
-
-def test_between_dates(conda_cli, tmp_path):
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--after",
-        "2023",
-        "--before",
-        "2024",
-        "--platform",
-        "linux-64",
-        "--output",
-        tmp_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
-    tested = 0
-    timestamp_2023 = datetime(2023, 1, 1, tzinfo=timezone.utc).timestamp()
-    timestamp_2024 = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
-    for subdir in context.subdir, "noarch":
-        if (tmp_path / subdir / "repodata.json").is_file():
-            tested += 1
-            channel = Channel(str(tmp_path / subdir))
-            sd = SubdirData(channel)
-            sd.load()
-            assert all(
-                timestamp_2023 <= rec.timestamp <= timestamp_2024 for rec in sd.iter_records()
-            )
-    assert tested
-
-
-def test_base_url(conda_cli, tmp_path):
+
+def test_base_url(conda_cli, tmp_path, fake_channel):
     base_url = "https://a-redefined-base.url"
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
+    _subchannel(
+        conda_cli,
+        fake_channel,
         "--keep",
         "python=3.9",
         "--base-url",
@@ -239,20 +133,16 @@ def test_base_url(conda_cli, tmp_path):
         "--output",
         tmp_path,
     )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
 
     data = json.loads((tmp_path / context.subdir / "repodata.json").read_text())
     assert data["info"]["base_url"] == base_url
 
 
-def test_served_at(conda_cli, tmp_path):
+def test_served_at(conda_cli, tmp_path, fake_channel):
     served_at = "https://my-fancy-channel.url"
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
+    _subchannel(
+        conda_cli,
+        fake_channel,
         "--keep",
         "python=3.9",
         "--served-at",
@@ -260,66 +150,103 @@ def test_served_at(conda_cli, tmp_path):
         "--output",
         tmp_path,
     )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
 
     for path in tmp_path.glob("**/index.html"):
         assert served_at in path.read_text()
 
 
-def test_pruned_python(conda_cli, tmp_path):
+def test_pruned_python(conda_cli, tmp_path, fake_channel):
     spec = "python=3.9"
     channel_path = tmp_path / "channel"
-    out, err, rc = conda_cli(
-        "subchannel",
-        "-c",
-        "conda-forge",
-        "--prune",
-        spec,
-        "--output",
-        channel_path,
-    )
-    print(out)
-    print(err, file=sys.stderr)
-    assert rc == 0
+    _subchannel(conda_cli, fake_channel, "--prune", spec, "--output", channel_path)
 
     # This should be solvable, we didn't remove anything other than non-39 pythons
     with pytest.raises(DryRunExit):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "python=3.9",
-        )
+        _dry_run_create(conda_cli, channel_path, "python=3.9")
 
     # This should be unsolvable, we didn't take Python 3.10 in the subchannel
     with pytest.raises(PackagesNotFoundError):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "python=3.10",
-        )
+        _dry_run_create(conda_cli, channel_path, "python=3.10")
 
     # This should work because, we just removed pythons that are not python=3.9, but the rest
-    # of the conda-forge packages should be there
+    # of the channel packages should be there
+    with pytest.raises(DryRunExit):
+        _dry_run_create(conda_cli, channel_path, "nodejs")
+
+
+@pytest.mark.parametrize(
+    "modes",
+    (("zstd",), ("bz2",), ("bz2", "zstd"), ("zstd", "bz2")),
+    ids=("zstd", "bz2", "bz2-then-zstd", "zstd-then-bz2"),
+)
+def test_output_files(conda_cli, tmp_path, fake_channel, modes):
+    expected = {
+        "zstd": [REPODATA_STATE_FN, "index.html", "repodata.json", "repodata.json.zst"],
+        "bz2": [
+            REPODATA_STATE_FN,
+            "index.html",
+            "repodata.json",
+            "repodata.json.bz2",
+            "repodata.json.zst",
+        ],
+    }
+    # Runs share the same output, so files from a previous mode must not linger
+    for mode in modes:
+        emit_bz2 = ("--emit-bz2",) if mode == "bz2" else ()
+        _subchannel(conda_cli, fake_channel, "--keep", "python", *emit_bz2, "--output", tmp_path)
+        for subdir in context.subdir, "noarch":
+            assert sorted(os.listdir(tmp_path / subdir)) == expected[mode]
+
+
+def test_index_html_checksums(conda_cli, tmp_path, fake_channel):
+    _subchannel(conda_cli, fake_channel, "--keep", "python", "--emit-bz2", "--output", tmp_path)
+    row = re.compile(
+        r">(repodata\.json[^<]*)</a>.*?<code>([0-9a-f]{64})</code>.*?<code>([0-9a-f]{32})</code>",
+        re.DOTALL,
+    )
+    for subdir in context.subdir, "noarch":
+        html = (tmp_path / subdir / "index.html").read_text()
+        published = {name: (sha256, md5) for name, sha256, md5 in row.findall(html)}
+        assert sorted(published) == ["repodata.json", "repodata.json.bz2", "repodata.json.zst"]
+        for name, checksums in published.items():
+            data = (tmp_path / subdir / name).read_bytes()
+            assert checksums == (hashlib.sha256(data).hexdigest(), hashlib.md5(data).hexdigest())
+
+
+def test_zstd_one_shot(conda_cli, tmp_path, fake_channel):
+    _subchannel(conda_cli, fake_channel, "--keep", "python", "--output", tmp_path)
+    for subdir in context.subdir, "noarch":
+        path = tmp_path / subdir / "repodata.json"
+        # Fails if the frame header doesn't have the content size
+        data = zstandard.ZstdDecompressor().decompress(path.with_suffix(".json.zst").read_bytes())
+        assert data == path.read_bytes()
+
+
+def test_noarch_placeholder_replaces_previous_run(conda_cli, tmp_path, fake_channel):
+    _subchannel(
+        conda_cli,
+        fake_channel,
+        "--keep",
+        "pip",
+        "--keep",
+        "python",
+        "--emit-bz2",
+        "--output",
+        tmp_path,
+    )
+    _subchannel(conda_cli, fake_channel, "--keep", "python", "--emit-bz2", "--output", tmp_path)
+    noarch = tmp_path / "noarch"
+    assert (noarch / "repodata.json").read_bytes() == b"{}"
+    zst = (noarch / "repodata.json.zst").read_bytes()
+    assert zstandard.ZstdDecompressor().decompress(zst) == b"{}"
+    assert bz2.decompress((noarch / "repodata.json.bz2").read_bytes()) == b"{}"
+
+
+@pytest.mark.integration
+def test_python_tree_conda_forge(conda_cli, tmp_path, conda_forge):
+    channel_path = tmp_path / "channel"
+    _subchannel(conda_cli, conda_forge, "--keep-tree", "python=3.9", "--output", channel_path)
+
+    # The tree of a real world package should be solvable
     with pytest.raises(DryRunExit):
-        conda_cli(
-            "create",
-            "--dry-run",
-            "-n",
-            "unused",
-            "--override-channels",
-            "--channel",
-            channel_path,
-            "nodejs",
-        )
\ No newline at end of file
+        _dry_run_create(conda_cli, channel_path, "python=3.9")